@@ -94,6 +94,14 @@ namespace morTimmy {
               int distance = distanceSensor.getDistance();
 
               message_t msg;              
+
+              // Handle all complete messages from the raspberry
+              while (raspberry.recvMessage(msg)) {
+                if (msg.module == MODULE_ARDUINO && msg.commandType == CMD_ARDUINO_TIMESYNC) {
+                  raspberry.replyTimeSync(msg);
+                }
+              }
+
               msg.module = MODULE_DISTANCE_SENSOR;
               msg.commandType = CMD_ARDUINO_START;
               msg.acknowledgeID = 0;
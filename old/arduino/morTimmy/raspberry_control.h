@@ -21,6 +21,8 @@ namespace morTimmy {
   byte CMD_ARDUINO_STOP_NACK = 0x67;
   byte CMD_ARDUINO_RESTART = 0x68;
   byte CMD_ARDUINO_RESTART_NACK = 0x69;
+  byte CMD_ARDUINO_TIMESYNC = 0x6A;        // answered by RaspberryController::replyTimeSync
+  byte CMD_ARDUINO_TIMESYNC_NACK = 0x6B;
 
   // Distance Sensor
   byte MODULE_DISTANCE_SENSOR = 0x31;
@@ -60,18 +62,68 @@ namespace morTimmy {
         */
       RaspberryController() {
         lastMessageID = 0;
+        recvLength = 0;
+        recvEscaped = false;
+        recvOverflow = false;
       }
       
       /**
         * @brief Receive and parse a message over the serial interface
-        * @param msg: a message_t structure consisting of the message data
+        *
+        * Reads the bytes waiting on the serial port until a complete
+        * and valid message is found. Every unescaped FRAME_FLAG ends
+        * the current frame and starts the next one, frames with the
+        * wrong length or checksum are dropped. This mirrors the
+        * FrameDecoder on the Raspberry Pi.
+        *
+        * @param msg: a message_t structure the received message is copied to
+        * @return true if a valid message was received
         */
-      void recvMessage() {
-          int numBytesAvailable = Serial.available();
+      bool recvMessage(message_t &msg) {
+          while (Serial.available() > 0) {
+              byte recvByte = Serial.read();
+
+              if (recvEscaped) {
+                  recvEscaped = false;
+              } else if (recvByte == FRAME_ESC) {
+                  recvEscaped = true;
+                  continue;
+              } else if (recvByte == FRAME_FLAG) {
+                  bool complete = (!recvOverflow && recvLength == sizeof(msg));
+                  recvLength = 0;
+                  recvOverflow = false;
+                  if (complete && unpackMessage(msg)) {
+                      return true;
+                  }
+                  continue;
+              }
 
-          while (numBytesAvailable > 0) {
-              // TODO: check if we receive start of a message and grab it until end of message is received
+              if (recvLength < sizeof(recvBuffer)) {
+                  recvBuffer[recvLength++] = recvByte;
+              } else {
+                  // Frame too long, discard everything up to the next flag
+                  recvOverflow = true;
+              }
           }
+          return false;
+      }
+
+      /**
+        * @brief Answer a time sync request from the Raspberry Pi
+        *
+        * The reply carries the messageID of the request in acknowledgeID
+        * and the current millis() in data. The Pi uses it to estimate
+        * the offset and drift of our clock.
+        *
+        * @param request: the received CMD_ARDUINO_TIMESYNC message
+        */
+      void replyTimeSync(const message_t &request) {
+          message_t reply;
+          reply.acknowledgeID = request.messageID;
+          reply.module = MODULE_ARDUINO;
+          reply.commandType = CMD_ARDUINO_TIMESYNC;
+          reply.data = millis();
+          sendMessage(reply);
       }
 
       /**
@@ -103,27 +155,18 @@ namespace morTimmy {
           }
         }
         
-        // If we have found special chars we create a new temp.
-        // byteMsg string with the appropriate size which
-        // we'll append FLAG_ESC to on the appropriate places
+        // If we have found special chars we write the message
+        // byte by byte, preceding every special char with FRAME_ESC
         if (msgSizeIncrease > 0) {
 
-          char tmpByteMsg[sizeof(msg)+msgSizeIncrease];
-          memcpy(tmpByteMsg, &byteMsg, sizeof(msg));
-        
-          int bytesAdded = 0;  // keeps track of how many bytes we've added to offset the memmove
+          Serial.write(FRAME_FLAG);
           for (int i = 0; i < sizeof(byteMsg); i++) {
             if (byteMsg[i] == FRAME_FLAG || byteMsg[i] == FRAME_ESC) {
-              memmove(tmpByteMsg +i + 1,
-                      tmpByteMsg + i + bytesAdded,
-                      sizeof(tmpByteMsg) - (i + 1));
-              tmpByteMsg[i] = FRAME_ESC;
-              bytesAdded++;
-             }
+              Serial.write(FRAME_ESC);
+            }
+            Serial.write(byteMsg[i]);
           }
           Serial.write(FRAME_FLAG);
-          Serial.write(tmpByteMsg, sizeof(tmpByteMsg));
-          Serial.write(FRAME_FLAG);    
         } else {
 
         // Print the packet bytes to the serial port including
@@ -152,6 +195,31 @@ namespace morTimmy {
           */ 
         } 
       }      
+
+    private:
+
+      byte recvBuffer[sizeof(message_t)];    // unescaped bytes of the current frame
+      unsigned int recvLength;               // number of bytes in recvBuffer
+      bool recvEscaped;                      // last byte was an unescaped FRAME_ESC
+      bool recvOverflow;                     // current frame is too long, wait for next flag
+
+      /**
+        * @brief Copy the received frame into msg and verify its checksum
+        * @param msg: a message_t structure the received message is copied to
+        * @return true if the checksum is valid
+        */
+      bool unpackMessage(message_t &msg) {
+          memcpy(&msg, recvBuffer, sizeof(msg));
+          unsigned long recvChecksum = msg.checksum;
+
+          // The checksum is calculated with the checksum field set to 0
+          msg.checksum = 0;
+          char byteMsg[sizeof(msg)];
+          memcpy(byteMsg, &msg, sizeof(msg));
+          msg.checksum = recvChecksum;
+
+          return (crc_string(byteMsg, sizeof(byteMsg)) == recvChecksum);
+      }
   };
 };
 
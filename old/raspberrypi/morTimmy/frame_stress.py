@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+from time import process_time
+from framing import *
+
+
+class FrameStressTest:
+
+    """ Corruption stress harness for the FrameDecoder
+
+    A stream of random but valid frames is generated, corrupted at
+    the configured rates and fed to a FrameDecoder in randomly sized
+    chunks, the way bytes come off the serial port. Every payload the
+    decoder returns goes through unpackMessage, just like on the robot.
+
+    Three kinds of corruption events are injected:
+        bit flip        a single bit of a byte is inverted
+        dropped byte    a byte is removed from the stream
+        truncation      a frame is cut off at a random position
+
+    Rates for bit flips and dropped bytes are per byte, the truncation
+    rate is per frame.
+
+    The report contains:
+        good frames     messages accepted that were sent unchanged
+        false accepts   messages accepted that were never sent, i.e.
+                        corruption that slipped past the checksum
+        bytes lost      bytes of frames that never made it through,
+                        divided by the number of corruption events.
+                        This includes intact frames lost while the
+                        decoder was resyncing
+        throughput      good frames decoded per second of CPU time
+    """
+
+    def __init__(self, numFrames=10000, bitFlipRate=0.0,
+                 dropRate=0.0, truncateRate=0.0, maxChunkSize=64,
+                 seed=None):
+        """ Initializes the stress test
+
+        Args:
+            numFrames (int): Number of frames to send
+            bitFlipRate (float): Chance per byte of a bit flip
+            dropRate (float): Chance per byte of the byte being dropped
+            truncateRate (float): Chance per frame of being truncated
+            maxChunkSize (int): Largest chunk fed to the decoder at once
+            seed (int): Seed for the random generator, for repeatable runs
+        """
+
+        self.numFrames = numFrames
+        self.bitFlipRate = bitFlipRate
+        self.dropRate = dropRate
+        self.truncateRate = truncateRate
+        self.maxChunkSize = maxChunkSize
+        self.random = random.Random(seed)
+
+    def generateMessages(self):
+        """ Returns a list of random valid messages """
+
+        return [packMessage(messageID,
+                            self.random.getrandbits(32),
+                            self.random.getrandbits(8),
+                            self.random.getrandbits(8),
+                            self.random.getrandbits(32))
+                for messageID in range(1, self.numFrames + 1)]
+
+    def corruptFrame(self, frame):
+        """ Apply random corruption to a frame
+
+        Returns:
+            A tuple of the corrupted frame and the number of
+            corruption events applied to it
+        """
+
+        events = 0
+        corrupted = bytearray()
+        for byte in frame:
+            if self.dropRate and self.random.random() < self.dropRate:
+                events += 1
+                continue
+            if self.bitFlipRate and self.random.random() < self.bitFlipRate:
+                byte ^= 1 << self.random.randrange(8)
+                events += 1
+            corrupted.append(byte)
+
+        if (self.truncateRate and corrupted and
+                self.random.random() < self.truncateRate):
+            del corrupted[self.random.randrange(len(corrupted)):]
+            events += 1
+
+        return bytes(corrupted), events
+
+    def run(self):
+        """ Run the stress test
+
+        Returns:
+            A dictionary with the results
+        """
+
+        messages = self.generateMessages()
+        frames = [packFrame(message) for message in messages]
+
+        stream = bytearray()
+        events = 0
+        for frame in frames:
+            corrupted, frameEvents = self.corruptFrame(frame)
+            stream += corrupted
+            events += frameEvents
+
+        chunks = []
+        position = 0
+        while position < len(stream):
+            chunkSize = self.random.randint(1, self.maxChunkSize)
+            chunks.append(bytes(stream[position:position + chunkSize]))
+            position += chunkSize
+
+        decoder = FrameDecoder()
+        accepted = []
+        startTime = process_time()
+        for chunk in chunks:
+            for payload in decoder.feed(chunk):
+                if unpackMessage(payload) is not None:
+                    accepted.append(payload)
+        elapsed = process_time() - startTime
+
+        sent = {message: index for index, message in enumerate(messages)}
+        delivered = set()
+        falseAccepts = 0
+        for payload in accepted:
+            index = sent.get(payload)
+            if index is None:
+                falseAccepts += 1
+            else:
+                delivered.add(index)
+
+        bytesLost = sum(len(frame) for index, frame in enumerate(frames)
+                        if index not in delivered)
+
+        return {'framesSent': len(frames),
+                'bytesSent': sum(len(frame) for frame in frames),
+                'corruptionEvents': events,
+                'goodFrames': len(delivered),
+                'accepted': len(accepted),
+                'falseAccepts': falseAccepts,
+                'falseAcceptRate': falseAccepts / len(accepted)
+                if accepted else 0.0,
+                'bytesLost': bytesLost,
+                'bytesLostPerEvent': bytesLost / events if events else 0.0,
+                'framesDropped': decoder.framesDropped,
+                'bytesDiscarded': decoder.bytesDiscarded,
+                'decodeTime': elapsed,
+                'throughput': len(delivered) / elapsed if elapsed else 0.0}
+
+
+def main():
+    """ Run the frame decoder stress test from the command line """
+
+    parser = argparse.ArgumentParser(
+        description="Stress test the morTimmy frame decoder with "
+                    "corrupted input")
+    parser.add_argument('--frames', type=int, default=10000,
+                        help="number of frames to send")
+    parser.add_argument('--bit-flip-rate', type=float, default=0.001,
+                        help="chance per byte of a bit flip")
+    parser.add_argument('--drop-rate', type=float, default=0.001,
+                        help="chance per byte of a dropped byte")
+    parser.add_argument('--truncate-rate', type=float, default=0.01,
+                        help="chance per frame of a truncated frame")
+    parser.add_argument('--max-chunk-size', type=int, default=64,
+                        help="largest chunk fed to the decoder at once")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="seed for repeatable runs")
+    args = parser.parse_args()
+
+    result = FrameStressTest(numFrames=args.frames,
+                             bitFlipRate=args.bit_flip_rate,
+                             dropRate=args.drop_rate,
+                             truncateRate=args.truncate_rate,
+                             maxChunkSize=args.max_chunk_size,
+                             seed=args.seed).run()
+
+    print("frames sent:         %d (%d bytes)" % (result['framesSent'],
+                                                  result['bytesSent']))
+    print("corruption events:   %d" % result['corruptionEvents'])
+    print("good frames:         %d (%.2f%%)" % (
+        result['goodFrames'],
+        100.0 * result['goodFrames'] / result['framesSent']))
+    print("false accepts:       %d (rate %.6f)" % (result['falseAccepts'],
+                                                   result['falseAcceptRate']))
+    print("bytes lost:          %d (%.1f per event)" % (
+        result['bytesLost'], result['bytesLostPerEvent']))
+    print("decoder drops:       %d frames, %d bytes discarded" % (
+        result['framesDropped'], result['bytesDiscarded']))
+    print("throughput:          %.0f good frames/s of CPU time" % result['throughput'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import struct               # Python struct library for constructing the message
+from zlib import crc32      # used to calculate a message checksum
+
+# Definitions
+
+# Frames
+FRAME_FLAG = 0x0C       # Marks the start and end of a frame
+FRAME_ESC = 0x1B        # Escape char for frame
+
+# Messages
+MESSAGE_FORMAT = '<LLBBLL'
+MESSAGE_SIZE = struct.calcsize(MESSAGE_FORMAT)
+MAX_FRAME_LENGTH = MESSAGE_SIZE     # longest unescaped payload of a frame
+
+
+def packMessage(messageID, acknowledgeID, module, commandType, data=0):
+    """ Creates a message understood by the Arduino
+
+    The checksum is calculated over the full packet with checksum field
+    set to 0. The data is then repacked again with the calculated
+    checksum. & 0xffffffff is ensuring the checksum is an unsigned long
+    as 32bit python sometimes returns a signed int
+
+    Returns:
+        Message byte string
+    """
+
+    rawMessage = struct.pack(MESSAGE_FORMAT, messageID, acknowledgeID,
+                             module, commandType, data, 0)
+    checksum = crc32(rawMessage) & 0xffffffff
+
+    return struct.pack(MESSAGE_FORMAT, messageID, acknowledgeID,
+                       module, commandType, data, checksum)
+
+
+def unpackMessage(message):
+    """ Unpacks and verifies a message received from the Arduino
+
+    Args:
+        message (bytes): A message unpacked from a frame
+
+    Returns:
+        A dictionary with the message fields or None if the message
+        has the wrong length or the checksum does not match
+    """
+
+    if len(message) != MESSAGE_SIZE:
+        return None
+
+    (messageID, acknowledgeID, module, commandType,
+     data, recvChecksum) = struct.unpack(MESSAGE_FORMAT, message)
+
+    rawMessage = struct.pack(MESSAGE_FORMAT, messageID, acknowledgeID,
+                             module, commandType, data, 0)
+    if crc32(rawMessage) & 0xffffffff != recvChecksum:
+        return None
+
+    return {'messageID': messageID,
+            'acknowledgeID': acknowledgeID,
+            'module': module,
+            'commandType': commandType,
+            'data': data,
+            'checksum': recvChecksum}
+
+
+def packFrame(message):
+    """ Packs the message into a frame
+
+    Escapes any special chars and applies the frame marker to the
+    beginning and end of the frame
+
+    Args:
+        message (bytes): The message to be sent to the arduino
+
+    Returns:
+        A packed frame suitable for sending to the arduino
+        over the serial connection.
+    """
+
+    frame = bytearray([FRAME_FLAG])
+    for byte in message:
+        if byte == FRAME_ESC or byte == FRAME_FLAG:
+            frame.append(FRAME_ESC)
+        frame.append(byte)
+    frame.append(FRAME_FLAG)
+
+    return bytes(frame)
+
+
+class FrameDecoder:
+
+    """ Incremental decoder for frames received from the Arduino
+
+    Bytes are fed in as they come off the serial port, in chunks of
+    any size. Completed frame payloads are returned by feed().
+
+    Every unescaped FRAME_FLAG both ends the current frame and starts
+    the next one. Empty frames between two flags are skipped, so the
+    decoder resynchronises on the very next flag after a lost or
+    mangled flag instead of staying out of step with the sender.
+
+    A payload can never grow beyond maxFrameLength. When a stray
+    FRAME_ESC swallows a closing flag, or the closing flag is lost
+    altogether, the frame is dropped as soon as it gets too long and
+    the bytes up to the next flag are discarded. This keeps the buffer
+    bounded and stops two frames being merged into one.
+
+    Decoded payloads are not verified, use unpackMessage() to check
+    their length and checksum.
+    """
+
+    def __init__(self, maxFrameLength=MAX_FRAME_LENGTH):
+        """ Initializes the decoder
+
+        Args:
+            maxFrameLength (int): Longest unescaped payload accepted
+        """
+
+        self.maxFrameLength = maxFrameLength
+        self.framesDecoded = 0      # payloads returned by feed()
+        self.framesDropped = 0      # payloads dropped for being too long
+        self.bytesDiscarded = 0     # bytes thrown away while resyncing
+
+        self.__buffer = bytearray()
+        self.__escaped = False
+        self.__overflow = False
+
+    def reset(self):
+        """ Forget any partially received frame """
+
+        self.__buffer = bytearray()
+        self.__escaped = False
+        self.__overflow = False
+
+    def feed(self, data):
+        """ Feed received bytes into the decoder
+
+        Args:
+            data (bytes): Bytes read from the serial port
+
+        Returns:
+            A list of frame payloads (bytes) completed by data
+        """
+
+        payloads = []
+        buffer = self.__buffer
+
+        for byte in data:
+            if self.__escaped:
+                self.__escaped = False
+            elif byte == FRAME_ESC:
+                self.__escaped = True
+                continue
+            elif byte == FRAME_FLAG:
+                if self.__overflow:
+                    self.__overflow = False
+                elif buffer:
+                    payloads.append(bytes(buffer))
+                    self.framesDecoded += 1
+                    buffer.clear()
+                continue
+
+            if self.__overflow:
+                self.bytesDiscarded += 1
+            elif len(buffer) >= self.maxFrameLength:
+                self.__overflow = True
+                self.framesDropped += 1
+                self.bytesDiscarded += len(buffer) + 1
+                buffer.clear()
+            else:
+                buffer.append(byte)
+
+        return payloads
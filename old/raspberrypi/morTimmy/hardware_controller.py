@@ -1,18 +1,15 @@
 #!/usr/bin/env python3
 
 import serial			    # pyserial library for serial communications
-import struct 	         	# Python struct library for constructing the message
 import queue
-from zlib import crc32      # used to calculate a message checksum
-from time import sleep
+from time import sleep, monotonic
 import logging
+from framing import *       # frame and message encoding
+from time_sync import TimeSync
+from profiler import stageTimer
 
 # Definitions
 
-# Frames
-FRAME_FLAG = 0x0C       # Marks the start and end of a frame
-FRAME_ESC = 0x1B        # Escape char for frame
-
 # Arduino
 MODULE_ARDUINO = 0x30
 CMD_ARDUINO_START = 0x64
@@ -21,6 +18,8 @@ CMD_ARDUINO_STOP = 0x66
 CMD_ARDUINO_STOP_NACK = 0x67
 CMD_ARDUINO_RESTART = 0x68
 CMD_ARDUINO_RESTART_NACK = 0x69
+CMD_ARDUINO_TIMESYNC = 0x6A
+CMD_ARDUINO_TIMESYNC_NACK = 0x6B
 
 # Distance Sensor
 MODULE_DISTANCE_SENSOR = 0x31
@@ -84,23 +83,36 @@ class HardwareController():
         DistanceSensor          Handles the distance sensor
         AccelerationSensor      Handles the Acceleration sensor
         CompassSensor           Handles the Compass sensor
+
+    Clock synchronisation with the Arduino uses the messageID and
+    acknowledgeID fields. syncTime() sends a CMD_ARDUINO_TIMESYNC
+    message, the Arduino replies with the messageID of the request as
+    acknowledgeID and its millis() value as data. See the TimeSync
+    class for the details.
     """
 
     __lastMessageID = 0        # holds the last used messageID
     isConnected = False
     __distanceSensorValues = [0, 3, 0]    # holds the last three measured vals
+    __lastMotorCommand = None   # holds the last (commandType, data) sent
+    __lastMotorCommandTime = None   # monotonic() time it was last sent
 
     def __init__(self):
         """ Initializes the HardwareController
 
         This sets up the recvMessageQueue which will hold
-        all the received messages from the Arduino
+        all the received messages from the Arduino and the
+        TimeSync used to estimate the Arduino clock
 
         TODO: Implement threading/queuing for the serial
         read process
         """
 
         self.recvMessageQueue = queue.Queue()
+        self.frameDecoder = FrameDecoder()
+        self.invalidMessages = 0
+        self.lastSendTime = None    # monotonic() time of the last write
+        self.timeSync = TimeSync()
         logging.getLogger()
 
     def setDistance(self, distance):
@@ -113,8 +125,9 @@ class HardwareController():
 
         self.__distanceSensorValues.pop(0)
         self.__distanceSensorValues.append(distance)
-        logging.info("morTimmy: new distance "
-                     "value is %s") % str(self.__distanceSensorValues)
+        with stageTimer.span('log'):
+            logging.info("morTimmy: new distance "
+                         "value is %s", self.__distanceSensorValues)
 
     def getDistance(self, numOfSamples=3):
         """ get the distance measures by the distance sensor
@@ -125,6 +138,52 @@ class HardwareController():
 
         return sum(self.__distanceSensorValues)/numOfSamples
 
+    def setMotorSpeed(self, leftMotorSpeed, rightMotorSpeed,
+                      refreshInterval=0.25):
+        """ Drive the motors using left and right motor speeds
+
+        The speeds (-255 to 255) are translated into the motor
+        commands the Arduino understands. Equal speeds drive forward
+        or back, opposite speeds turn on the spot.
+
+        To keep the serial link free a command equal to the previous
+        one is not sent again right away. The Arduino does not
+        acknowledge motor commands though, so it is repeated once
+        refreshInterval has passed. A lost frame, including a stop,
+        is then made good on the next refresh.
+
+        Args:
+            leftMotorSpeed (int): Speed of the left side motors
+            rightMotorSpeed (int): Speed of the right side motors
+            refreshInterval (float): Seconds after which an unchanged
+                                     command is sent again
+
+        Returns:
+            The messageID of the sent message or None if nothing was sent
+        """
+
+        speed = min(255, int(max(abs(leftMotorSpeed), abs(rightMotorSpeed))))
+        if speed == 0:
+            command = (CMD_MOTOR_STOP, 0)
+        elif leftMotorSpeed > 0 and rightMotorSpeed > 0:
+            command = (CMD_MOTOR_FORWARD, speed)
+        elif leftMotorSpeed < 0 and rightMotorSpeed < 0:
+            command = (CMD_MOTOR_BACK, speed)
+        elif leftMotorSpeed < rightMotorSpeed:
+            command = (CMD_MOTOR_LEFT, speed)
+        else:
+            command = (CMD_MOTOR_RIGHT, speed)
+
+        if (command == self.__lastMotorCommand and
+                monotonic() - self.__lastMotorCommandTime < refreshInterval):
+            return None
+
+        messageID = self.sendMessage(MODULE_MOTOR, *command)
+        if messageID is not None:
+            self.__lastMotorCommand = command
+            self.__lastMotorCommandTime = monotonic()
+        return messageID
+
     def initialize(self, serialPort='/dev/ttyACM0',
                    baudrate=9600,
                    stopbits=serial.STOPBITS_ONE,
@@ -149,9 +208,12 @@ class HardwareController():
         """
 
         try:
-            logging.info("Opening serial connection to arduino on"
-                         "port %s with baudrate %d") % (serialPort, baudrate)
-            self.serialPort = serial.Serial(serialPort, baudrate)
+            logging.info("Opening serial connection to arduino on "
+                         "port %s with baudrate %d", serialPort, baudrate)
+            self.serialPort = serial.Serial(serialPort, baudrate,
+                                            stopbits=stopbits,
+                                            bytesize=bytesize,
+                                            timeout=timeout)
             logging.info("Connected to Arduino")
 
             '''  Reset the arduino by setting the DTR pin LOW and then
@@ -164,6 +226,8 @@ class HardwareController():
             self.serialPort.setDTR(level=False)
             sleep(0.5)
             self.serialPort.flushInput()
+            self.frameDecoder.reset()
+            self.__lastMotorCommand = None
             self.serialPort.setDTR()
 
             logging.info("TODO: implement proper handshake between Arduino "
@@ -178,7 +242,7 @@ class HardwareController():
             self.isConnected = True
         except OSError:
             logging.error("Failed to connect to Arduino on "
-                          "serial port %s. Is the port correct?") % serialPort
+                          "serial port %s. Is the port correct?", serialPort)
             self.isConnected = False
         except Exception:
             logging.warning("Could not connect to Arduino")
@@ -194,14 +258,13 @@ class HardwareController():
     def __packMessage(self, module, commandType, data=0, acknowledgeID=0):
         """ Creates a message understood by the Arduino
 
-        The checksum is calculated over the full packet with checksum field
-        set to 0. The data is then repacked again with the calculated
-        checksum
+        Takes the next messageID and packs the message including
+        its checksum, see framing.packMessage
 
           Message structure
-        +-----------+--------+-------------+-------+----------+
-        | messageID | module | commandType |  data | checksum |
-        +-----------+--------+-------------+-------+----------+
+        +-----------+---------------+--------+-------------+------+----------+
+        | messageID | acknowledgeID | module | commandType | data | checksum |
+        +-----------+---------------+--------+-------------+------+----------+
 
         Args:
             module:      (unsigned short, 1 byte, arduino module to target)
@@ -214,139 +277,62 @@ class HardwareController():
 
         self.__lastMessageID += 1
 
-        checksum = 0
-        rawMessage = struct.pack('<LLBBLL',
-                                 self.__lastMessageID,
-                                 acknowledgeID,
-                                 module,
-                                 commandType,
-                                 data,
-                                 checksum)
-
-        # Calculate the checksum. & 0xffffffff is ensuring
-        # the checksum is an unsigned long as 32bit python
-        # sometimes returns a signed int
-        checksum = crc32(rawMessage) & 0xffffffff
-
-        rawMessage = struct.pack('<LLBBLL',
-                                 self.__lastMessageID,
-                                 acknowledgeID,
-                                 module,
-                                 commandType,
-                                 data,
-                                 checksum)
-
-        return rawMessage
+        return packMessage(self.__lastMessageID,
+                           acknowledgeID,
+                           module,
+                           commandType,
+                           data)
 
     def __unpackMessage(self, message):
         """ Unpacks a message received from the Arduino
 
-        It unpacks the received struct into seperate variables.
-        Then it repacks the message again but with a checksum of 0
-        to verify the data is transmitted intact.
+        The message length and checksum are verified by
+        framing.unpackMessage. Invalid messages are only counted in
+        invalidMessages, nothing derived from them ends up on the
+        recvMessageQueue.
 
         A dictionary containing the received data is added to the
-        recvMessageQueue if the message was valid.
+        recvMessageQueue if the message was valid. Each message is
+        tagged with the local time it was received (recvTime) and the
+        estimated Arduino time it was sent (deviceTime, None until the
+        clocks are synchronized). Replies to our own time sync
+        requests are handled here and not added to the queue.
 
         Args:
-            message (struct): A message unpacked from a frame
+            message (bytes): A message unpacked from a frame
         """
-        try:
-            (messageID, acknowledgeID, module, commandType,
-             data, recvChecksum) = struct.unpack('<LLBBLL', message)
-
-            # recalculate the checksum to check if we received
-            # a valid message. & 0xffffffff is ensuring
-            # the checksum is an unsigned long as 32bit python 2.x
-            # sometimes returns a signed int
-
-            checksum = 0
-            rawMessage = struct.pack('<LLBBLL',
-                                     messageID,
-                                     acknowledgeID,
-                                     module,
-                                     commandType,
-                                     data,
-                                     checksum)
-
-            calcChecksum = crc32(rawMessage) & 0xffffffff
-
-            if recvChecksum == calcChecksum:
-                self.recvMessageQueue.put({'messageID': messageID,
-                                           'acknowledgeID': acknowledgeID,
-                                           'module': module,
-                                           'commandType': commandType,
-                                           'data': data,
-                                           'checksum': recvChecksum})
-            else:
-                self.recvMessageQueue.put("Invalid: Checksum failed")
-        except Exception:
-            self.recvMessageQueue.put("error putting messg to queue")
-
-    def __packFrame(self, message):
-        """ Packs the message into a frame
-
-        Escapes any special chars and applies
-        the frame marker to the beginning and end
-        of the frame
-
-        Args:
-            message (struct): The message to be sent to
-                              the arduino
 
-        Returns:
-            A packed frame suitable for sending to the arduino
-            over the serial connection. """
-
-        frame = b''
-        frame += chr(FRAME_FLAG)
-
-        for byte in message:
-            if (byte == chr(FRAME_ESC)) or (byte == chr(FRAME_FLAG)):
-                frame += chr(FRAME_ESC)
-                frame += byte          # TODO, Need to XOR this value?
-            else:
-                frame += byte
-
-        frame += chr(FRAME_FLAG)
-
-        return frame
-
-    def __unpackFrame(self, frame):
-        """ Unpacks a received frame from the arduino
-
-        Args:
-            frame (string): The received frame from
-                            the arduino
-        Returns:
-            message (struct): A received message from the
-                              arduino
-        """
-
-        nextByteValid = False   # Indicates we found a FRAME_ESC char
-        message = b''
-
-        if(frame[:1] != chr(FRAME_FLAG)) or (frame[-1:] != chr(FRAME_FLAG)):
-            print("Invalid frame received, frame flag not valid")
-            self.recvMessageQueue.put("Invalid")
+        recvTime = monotonic()
+        recvMessage = unpackMessage(message)
+
+        if recvMessage is None:
+            self.invalidMessages += 1
+            with stageTimer.span('log'):
+                logging.debug("Dropped invalid message of %d bytes",
+                              len(message))
+        elif (recvMessage['module'] == MODULE_ARDUINO and
+              recvMessage['commandType'] == CMD_ARDUINO_TIMESYNC and
+              self.timeSync.isPending(recvMessage['acknowledgeID'])):
+            self.timeSync.replyReceived(recvMessage['acknowledgeID'],
+                                        recvMessage['data'],
+                                        recvTime)
+            with stageTimer.span('log'):
+                logging.debug("timesync: offset=%.6fs drift=%.1fppm",
+                              self.timeSync.offset,
+                              self.timeSync.driftPpm)
         else:
-            for byte in frame:
-                if nextByteValid:
-                    message += byte
-                    nextByteValid = False
-                elif (byte == chr(FRAME_ESC)):
-                        nextByteValid = True
-                elif (byte != chr(FRAME_FLAG)):
-                        message += byte
-
-        return message
+            recvMessage['recvTime'] = recvTime
+            recvMessage['deviceTime'] = self.timeSync.estimateSendTime(
+                recvTime)
+            self.recvMessageQueue.put(recvMessage)
 
+    @stageTimer.timed('send')
     def sendMessage(self, module, commandType, data=0, acknowledgeID=0):
         """ Send data onto the serial port towards the arduino.
 
         Used by the HardwareController class to send commands. It packs
         the message into a struct using the given arguments. The packed
-        message then gets processed by __packFrame to ensure any special
+        message then gets processed by packFrame to ensure any special
         characters are escaped with FRAME_ESC and a beginning and end
         flag is added to the message.
 
@@ -354,6 +340,9 @@ class HardwareController():
             module (byte):      The module to address
             commandType (byte): The command to send to the specified module
             data (int):         The data that goes with the command (if any)
+
+        Returns:
+            The messageID of the sent message or None if not connected
         """
 
         if not self.isConnected:
@@ -364,29 +353,45 @@ class HardwareController():
                                            commandType,
                                            data,
                                            acknowledgeID)
-        packedFrame = self.__packFrame(packedMessage)
+        packedFrame = packFrame(packedMessage)
+
+        with stageTimer.span('log'):
+            logging.debug("morTimmy: "
+                          "msgID=%d "
+                          "ackID=%d "
+                          "module=%s "
+                          "cmd=%s "
+                          "data=%s ", self.__lastMessageID, acknowledgeID,
+                          hex(module), hex(commandType), data)
+
+        self.lastSendTime = monotonic()
+        self.serialPort.write(packedFrame)
+        return self.__lastMessageID
 
-        print ("morTimmy: "
-               "msgID=%d "
-               "ackID=%d "
-               "module=%s "
-               "cmd=%s "
-               "data=%s ") % (self.__lastMessageID, acknowledgeID, hex(module),
-                              hex(commandType), data)
+    def syncTime(self):
+        """ Send a time sync request to the Arduino
 
-        self.serialPort.write(packedFrame)
+        The local send time is registered with the TimeSync so the
+        reply can be matched on its acknowledgeID. sendMessage samples
+        the local clock right before writing to the serial port, so
+        packing and logging the message do not count towards the
+        measured round trip.
+        """
+
+        messageID = self.sendMessage(MODULE_ARDUINO, CMD_ARDUINO_TIMESYNC)
+        if messageID is not None:
+            self.timeSync.requestSent(messageID, self.lastSendTime)
 
     def recvMessage(self):
         """ Receive data from the Arduino through the serial port.
 
-        Used by the HardwareController class to receive
-        messages from the Arduino. It reads single bytes from the
-        serial port and starts processing when it finds the beginning
-        of a message (FRAME_FLAG). each subsequent byte is read and checked
-        for a FRAME_FLAG message or a FRAME_ESC escape flag for special
-        characters.
+        Used by the HardwareController class to receive messages from
+        the Arduino. It reads all bytes waiting on the serial port
+        without blocking and feeds them to the FrameDecoder, which
+        strips the FRAME_FLAG and FRAME_ESC characters and resyncs on
+        the next FRAME_FLAG after a corrupted frame.
 
-        When a full message is found it is passed to the __unpackMessage
+        Each complete message is passed to the __unpackMessage
         function. This converts the received message to a dictionary and
         adds it to the recvMessageQueue.
         """
@@ -395,31 +400,15 @@ class HardwareController():
             print("recvMessage: Not connected to Arduino")
             return None
 
-        message = b''
-        foundStartOfFrame = False
-        foundEndOfFrame = False
-        foundEscFlag = False
-
-        while not foundEndOfFrame:
-            recvByte = self.serialPort.read(1)
-            if foundStartOfFrame and recvByte == chr(FRAME_FLAG) and not foundEscFlag:
-                foundEndOfFrame = True
-            elif recvByte == chr(FRAME_FLAG) and not foundStartOfFrame:
-                # Beginning of our message
-                foundStartOfFrame = True
-            elif (foundStartOfFrame) and recvByte == chr(FRAME_ESC) and not foundEscFlag:
-                # Found an escape flag which was not escaped itself
-                foundEscFlag = True
-            elif foundStartOfFrame and foundEscFlag:
-                # Byte preceded by FLAG_ESC so treat as normal data
-                foundEscFlag = False
-                message += recvByte
-            elif foundStartOfFrame and not foundEscFlag:
-                # regular data part of message
-                message += recvByte
-
-        unpackedMessage = self.__unpackMessage(message)
-        self.recvMessageQueue.put(unpackedMessage)
+        with stageTimer.span('read'):
+            numBytesAvailable = self.serialPort.inWaiting()
+            if not numBytesAvailable:
+                return
+            data = self.serialPort.read(numBytesAvailable)
+
+        with stageTimer.span('decode'):
+            for message in self.frameDecoder.feed(data):
+                self.__unpackMessage(message)
 
 
 def main():
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 # imports
+import argparse
 import logging
+import logging.handlers
 from hardware_controller import *
-from time import sleep, time
+from time_sync import LatencyHistogram
+from telemetry_store import TelemetryStore
+from profiler import stageTimer, SamplingProfiler
+from planner import PlannerRuntime, avoidObstacles
+from time import sleep, time, monotonic
 import queue
+import signal
 
 
 class Robot:
@@ -25,12 +32,23 @@ class Robot:
     # instances of the class belong here. Others
     # should be initialised in __init__
     MIN_DISTANCE_TO_OBJECT = 10
+    TIME_SYNC_INTERVAL = 10         # seconds between clock sync requests
+    LATENCY_REPORT_INTERVAL = 60    # seconds between latency log entries
+    PROFILE_DURATION = 10           # seconds recorded by the profiler
+    PLAN_MAX_AGE = 0.25             # seconds a plan stays valid
 
-    def __init__(self):
+    def __init__(self, autonomous=False):
         """ Called when the robot class is created.
 
-        It intializes the sensor data queue and sets up the
-        logging output file
+        It intializes the sensor data queue, the on-disk telemetry
+        store and sets up the logging output file. The log is
+        rotated at LOG_MAX_BYTES so a robot logging every message at
+        DEBUG level does not fill the SD card. When autonomous is
+        set the robot is driven by a planner running in a separate
+        process, see PlannerRuntime.
+
+        Sending SIGUSR1 to the process records a profile of the robot
+        loop, SIGUSR2 switches the per stage timing on or off.
 
         Returns:
 
@@ -39,9 +57,15 @@ class Robot:
         """
 
         self.LOG_FILENAME = 'my_morTimmy.log'
-        logging.basicConfig(filename=self.LOG_FILENAME,
+        self.LOG_MAX_BYTES = 1024 * 1024   # size at which the log rotates
+        self.LOG_BACKUP_COUNT = 5           # rotated log files to keep
+        self.TELEMETRY_DIRECTORY = 'telemetry'
+        logHandler = logging.handlers.RotatingFileHandler(
+            self.LOG_FILENAME,
+            maxBytes=self.LOG_MAX_BYTES,
+            backupCount=self.LOG_BACKUP_COUNT)
+        logging.basicConfig(handlers=[logHandler],
                             level=logging.DEBUG,
-                            filemode='w',
                             format='%(asctime)s %(levelname)s %(message)s')
 
         self.state = self.State()
@@ -49,9 +73,25 @@ class Robot:
         self.arduino = HardwareController()
         self.runningTime = 0
         self.lastSensorReading = 0
+        self.lastTimeSync = 0
+        self.lastLatencyReport = monotonic()
+        self.dispatchLatency = LatencyHistogram('dispatch')
 
         logging.info('initialising morTimmy the robot')
         self.sensorDataQueue = queue.Queue()
+        self.telemetry = TelemetryStore(self.TELEMETRY_DIRECTORY)
+        self.planner = None
+        self.setpoint = None            # last MotorSetpoint from the planner
+        self.motorSpeed = (0, 0)        # (left, right) applied by the planner
+        if autonomous:
+            self.planner = PlannerRuntime(avoidObstacles,
+                                          maxAge=self.PLAN_MAX_AGE)
+            self.currentState = self.state.autonomous
+        self.profiler = SamplingProfiler()
+        self.profiler.installSignalHandler(signal.SIGUSR1,
+                                           self.PROFILE_DURATION)
+        signal.signal(signal.SIGUSR2,
+                      lambda signum, frame: self.toggleStageTiming())
         self.initialize()
 
     def initialize(self):
@@ -70,6 +110,7 @@ class Robot:
         logging.info('Connected to Arduino through serial connection')
         self.runningTime = 0
 
+    @stageTimer.timed('loop')
     def run(self):
         """ The main robot loop """
 
@@ -83,8 +124,25 @@ class Robot:
         if self.arduino.getDistance() <= self.MIN_DISTANCE_TO_OBJECT:
             pass
 
+        # Let the planner drive when autonomous, stale plans are
+        # dropped by the planner runtime. The robot is stopped as long
+        # as there is no valid plan. The motors are driven on every
+        # pass so setMotorSpeed can repeat commands that got lost
+        if self.currentState == self.state.autonomous:
+            with stageTimer.span('plan'):
+                setpoint = self.planner.poll()
+            if setpoint is not None:
+                self.setpoint = setpoint
+            if (self.setpoint is not None and
+                    monotonic() <= self.setpoint.deadline):
+                self.driveMotors(self.setpoint.leftMotorSpeed,
+                                 self.setpoint.rightMotorSpeed)
+            else:
+                if self.motorSpeed != (0, 0):
+                    logging.warning("planner: no fresh plan, stopping robot")
+                self.driveMotors(0, 0)
         # Move robot forward if stopped for 5sec
-        if self.currentState == self.state.stopped and (currentTime - self.runningTime) >= 5:
+        elif self.currentState == self.state.stopped and (currentTime - self.runningTime) >= 5:
             self.arduino.sendMessage(MODULE_MOTOR, CMD_MOTOR_FORWARD, 255)
             self.runningTime = currentTime
             self.currentState = self.state.running
@@ -96,44 +154,164 @@ class Robot:
             self.currentState = self.state.stopped
             print("Robot stopped")
 
+        # Keep the Arduino clock estimate up to date
+        if (monotonic() - self.lastTimeSync) >= self.TIME_SYNC_INTERVAL:
+            self.arduino.syncTime()
+            self.lastTimeSync = monotonic()
+
         # Read bytes from the Arduino and add messages to the Queue if found
-        self.arduino.recvMessage()
+        with stageTimer.span('receive'):
+            self.arduino.recvMessage()
 
         # Process all received messages in the queue
+        with stageTimer.span('dispatch'):
+            self.dispatchMessages()
+
+        if (monotonic() - self.lastLatencyReport) >= self.LATENCY_REPORT_INTERVAL:
+            with stageTimer.span('report'):
+                self.logLatency()
+            self.lastLatencyReport = monotonic()
+
+    def driveMotors(self, leftMotorSpeed, rightMotorSpeed):
+        """ Set the motor speeds and let the planner know about them
+
+        Unchanged speeds are sent to the Arduino again every
+        PLAN_MAX_AGE seconds. The applied speeds are only published
+        when they change, every publish makes the planner run again.
+        """
+
+        self.arduino.setMotorSpeed(leftMotorSpeed, rightMotorSpeed,
+                                   refreshInterval=self.PLAN_MAX_AGE)
+
+        if (leftMotorSpeed, rightMotorSpeed) != self.motorSpeed:
+            self.motorSpeed = (leftMotorSpeed, rightMotorSpeed)
+            self.planner.publish(leftMotorSpeed=leftMotorSpeed,
+                                 rightMotorSpeed=rightMotorSpeed)
+
+    def dispatchMessages(self):
+        """ Handle all messages received from the Arduino """
+
         while not self.arduino.recvMessageQueue.empty():
             recvMessage = self.arduino.recvMessageQueue.get_nowait()
 
-            if recvMessage is None:
-                # Why does the queue always return a None object?
-                break
-            elif recvMessage == 'Invalid':
-                logging.error('Received invalid packet, ignoring')
-            elif recvMessage['module'] == chr(MODULE_DISTANCE_SENSOR):
+            # Time between receiving the message and acting on it
+            self.dispatchLatency.add(monotonic() - recvMessage['recvTime'])
+
+            if recvMessage['module'] == MODULE_DISTANCE_SENSOR:
                 self.arduino.setDistance(recvMessage['data'])
+                # Stored against the wall clock time of receipt so the
+                # samples line up across restarts, not dispatch time
+                recvWallTime = time() - (monotonic() - recvMessage['recvTime'])
+                self.telemetry.append('distanceSensor', 'distance',
+                                      recvWallTime, recvMessage['data'])
+                self.lastSensorReading = recvMessage['recvTime']
+                if self.planner is not None:
+                    self.planner.publish(timestamp=self.lastSensorReading,
+                                         distance=self.arduino.getDistance())
             else:
-                logging.warning("Message with unknown module or command received. Message details:")
-                logging.warning("msgID: %d ackID: %d module: %s "
-                               "commandType: %s data: %d checksum: %s" % (recvMessage['messageID'],
-                                                                          recvMessage['acknowledgeID'],
-                                                                          hex(recvMessage['module']),
-                                                                          hex(recvMessage['commandType']),
-                                                                          recvMessage['data'],
-                                                                          hex(recvMessage['checksum'])))
+                with stageTimer.span('log'):
+                    logging.warning("Message with unknown module or command received. Message details:")
+                    logging.warning("msgID: %d ackID: %d module: %s "
+                                   "commandType: %s data: %d checksum: %s" % (recvMessage['messageID'],
+                                                                              recvMessage['acknowledgeID'],
+                                                                              hex(recvMessage['module']),
+                                                                              hex(recvMessage['commandType']),
+                                                                              recvMessage['data'],
+                                                                              hex(recvMessage['checksum'])))
+
+    def logLatency(self):
+        """ Log the clock estimate, latency histograms and link stats
+
+        The upstream and downstream histograms cover the serial link
+        plus the Arduino loop, the dispatch histogram covers the time
+        a received message waits in Robot.run before it is handled.
+        """
+
+        timeSync = self.arduino.timeSync
+        if timeSync.isSynchronized:
+            logging.info("timesync: offset=%.6fs drift=%.1fppm",
+                         timeSync.offset, timeSync.driftPpm)
+        else:
+            logging.info("timesync: not synchronized with Arduino yet")
+
+        for histogram in (timeSync.roundTrip, timeSync.upstream,
+                          timeSync.downstream, self.dispatchLatency):
+            logging.info("latency %s", histogram)
+
+        frameDecoder = self.arduino.frameDecoder
+        logging.info("link: frames=%d dropped=%d discardedBytes=%d "
+                     "invalidMessages=%d", frameDecoder.framesDecoded,
+                     frameDecoder.framesDropped, frameDecoder.bytesDiscarded,
+                     self.arduino.invalidMessages)
+
+        if self.telemetry.droppedSamples:
+            logging.warning("telemetry: dropped %d samples so far",
+                            self.telemetry.droppedSamples)
+
+        if self.planner is not None:
+            logging.info("planner: stale=%d failed=%d",
+                         self.planner.stalePlans, self.planner.failedPlans)
+
+        if stageTimer.enabled:
+            stageTimer.report()
+
+    def startProfile(self, duration=None):
+        """ Record a flamegraph profile of the robot loop
+
+        The profile is written as a collapsed stack file in the
+        current directory after duration seconds. Must be called from
+        the thread running the robot loop.
+
+        Returns:
+            The filename of the profile or None if one is running
+        """
+
+        return self.profiler.start(duration or self.PROFILE_DURATION)
+
+    def toggleStageTiming(self):
+        """ Switch the per stage timing of the robot loop on or off
+
+        When switching off the collected timings are logged.
+        """
+
+        if stageTimer.enabled:
+            stageTimer.disable()
+            stageTimer.report()
+        else:
+            stageTimer.enable()
+            logging.info("stage timing enabled")
+
+    def shutdown(self):
+        """ Stop the robot and write out any pending telemetry """
+
+        if self.arduino.isConnected:
+            self.arduino.sendMessage(MODULE_MOTOR, CMD_MOTOR_STOP)
+        if self.planner is not None:
+            self.planner.shutdown()
+        self.telemetry.close()
 
 
 def main():
     """ This is the main function of our script.
 
     It will only contain a very limited program
-    logic. The main action happens in the Robot class
+    logic. The main action happens in the Robot class.
     """
-    morTimmy = Robot()
+
+    parser = argparse.ArgumentParser(description="Run morTimmy the robot")
+    parser.add_argument('--autonomous', action='store_true',
+                        help="let the planner drive the robot")
+    args = parser.parse_args()
+
+    morTimmy = Robot(autonomous=args.autonomous)
 
     try:
         while(True):
             morTimmy.run()
     except KeyboardInterrupt:
         print("Thanks for running me!")
+    finally:
+        morTimmy.shutdown()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+import struct
+import signal
+import logging
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from time import monotonic
+
+# Definitions
+
+SENSOR_FIELDS = ('timestamp',           # monotonic() time of the reading
+                 'distance',            # averaged distance sensor value
+                 'leftMotorSpeed',      # speed currently sent to the motors
+                 'rightMotorSpeed')
+SEQUENCE = struct.Struct('<Q')
+SENSOR_STATE = struct.Struct('<%dd' % len(SENSOR_FIELDS))
+MAX_SNAPSHOT_RETRIES = 1000
+
+# Motor setpoint returned by a planner, deadline is a monotonic() time
+MotorSetpoint = namedtuple('MotorSetpoint',
+                           ['leftMotorSpeed', 'rightMotorSpeed', 'deadline'])
+
+
+class SensorStateBuffer:
+
+    """ Sensor state shared between the robot loop and planner processes
+
+    The state lives in a multiprocessing.shared_memory block that is
+    laid out as a sequence counter followed by one double per entry in
+    SENSOR_FIELDS. There is a single writer, the robot loop, and any
+    number of readers.
+
+    Access is guarded seqlock style. The writer makes the sequence odd,
+    writes the fields and makes the sequence even again. A reader
+    copies the fields and only accepts the copy when the sequence was
+    even and did not change while copying, otherwise it tries again.
+    Readers never block the writer, the robot loop can publish at any
+    time without waiting for a planner.
+    """
+
+    SIZE = SEQUENCE.size + SENSOR_STATE.size
+
+    def __init__(self, name=None):
+        """ Create a new buffer or attach to an existing one
+
+        Args:
+            name (str): Name of an existing buffer to attach to,
+                        None creates a new buffer
+        """
+
+        if name is None:
+            self.sharedMemory = shared_memory.SharedMemory(create=True,
+                                                           size=self.SIZE)
+            self.sharedMemory.buf[:self.SIZE] = bytes(self.SIZE)
+            self.isOwner = True
+        else:
+            self.sharedMemory = shared_memory.SharedMemory(name=name)
+            self.isOwner = False
+        self.name = self.sharedMemory.name
+        self.__sequence = 0
+
+    @property
+    def sequence(self):
+        """ Sequence number of the last write, moves on every publish """
+        return self.__sequence
+
+    def write(self, **fields):
+        """ Publish a new sensor state, fields missing keep their value
+
+        Only to be called from the process that created the buffer.
+        """
+
+        buf = self.sharedMemory.buf
+        values = list(SENSOR_STATE.unpack_from(buf, SEQUENCE.size))
+        for field, value in fields.items():
+            values[SENSOR_FIELDS.index(field)] = value
+
+        self.__sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.__sequence)
+        SENSOR_STATE.pack_into(buf, SEQUENCE.size, *values)
+        self.__sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.__sequence)
+
+    def read(self):
+        """ Take a consistent snapshot of the sensor state
+
+        Returns:
+            A dictionary with the sensor fields or None if the writer
+            kept changing the state for MAX_SNAPSHOT_RETRIES attempts
+        """
+
+        buf = self.sharedMemory.buf
+        for _ in range(MAX_SNAPSHOT_RETRIES):
+            before = SEQUENCE.unpack_from(buf, 0)[0]
+            if before % 2:
+                continue
+            values = SENSOR_STATE.unpack_from(buf, SEQUENCE.size)
+            if SEQUENCE.unpack_from(buf, 0)[0] == before:
+                return dict(zip(SENSOR_FIELDS, values))
+        return None
+
+    def close(self):
+        """ Detach from the buffer, the owner also removes it """
+
+        self.sharedMemory.close()
+        if self.isOwner:
+            self.sharedMemory.unlink()
+
+
+# Worker process side
+
+_workerSensorState = None     # SensorStateBuffer of the worker process
+_workerPlanner = None         # planner function of the worker process
+
+
+def _initWorker(bufferName, planner):
+    """ Attach a planner worker process to the sensor state
+
+    The planner is handed over once here, so submitting a plan does
+    not have to pickle it again every time. Ctrl-C sends SIGINT to the
+    whole process group, the workers ignore it and leave shutting down
+    to the robot.
+    """
+
+    global _workerSensorState, _workerPlanner
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _workerSensorState = SensorStateBuffer(bufferName)
+    _workerPlanner = planner
+
+
+def _runPlanner(maxAge):
+    """ Run a planner against the latest sensor state
+
+    The deadline of the result is based on the time of the sensor
+    reading, a plan is never fresher than the data it was based on.
+
+    Returns:
+        A MotorSetpoint or None if no sensor state was available
+    """
+
+    state = _workerSensorState.read()
+    if state is None or not state['timestamp']:
+        return None
+
+    leftMotorSpeed, rightMotorSpeed = _workerPlanner(state)
+    return MotorSetpoint(leftMotorSpeed, rightMotorSpeed,
+                         state['timestamp'] + maxAge)
+
+
+def avoidObstacles(state, minDistance=10, speed=255):
+    """ Simple planner driving forward and turning away from obstacles
+
+    Args:
+        state (dict): Snapshot of the sensor state
+
+    Returns:
+        A (leftMotorSpeed, rightMotorSpeed) tuple
+    """
+
+    if state['distance'] <= minDistance:
+        return (-speed, speed)
+    return (speed, speed)
+
+
+class PlannerRuntime:
+
+    """ Runs autonomy planning outside of the robot loop
+
+    Planning code like path choice or scan analysis would hold the
+    GIL and delay serial I/O when run inside Robot.run. The
+    PlannerRuntime runs it in a ProcessPoolExecutor instead.
+
+    The robot loop publishes sensor state with publish() and calls
+    poll() every iteration. At most one plan is in flight at a time
+    and a new one is only submitted once new sensor state has been
+    published since the last one, so the workers stay idle while
+    there is nothing new to plan on. A finished plan whose deadline has passed is
+    dropped and counted in stalePlans, the robot loop only ever acts
+    on fresh setpoints.
+
+    When a worker process dies, e.g. killed by the OOM killer, the
+    pool is broken. The failure is counted in failedPlans, the pool is
+    started again and poll() returns a stop setpoint so the robot does
+    not keep acting on its last decision.
+
+    The planner must be a picklable function, e.g. defined at module
+    level, taking a sensor state dictionary and returning a
+    (leftMotorSpeed, rightMotorSpeed) tuple.
+    """
+
+    def __init__(self, planner=avoidObstacles, maxAge=0.25, maxWorkers=1):
+        """ Initializes the runtime and starts the worker processes
+
+        Args:
+            planner (function): The planner to run
+            maxAge (float): Seconds after the sensor reading a plan
+                            stays valid
+            maxWorkers (int): Number of worker processes
+        """
+
+        self.planner = planner
+        self.maxAge = maxAge
+        self.maxWorkers = maxWorkers
+        self.stalePlans = 0
+        self.failedPlans = 0
+
+        self.sensorState = SensorStateBuffer()
+        self.__mpContext = multiprocessing.get_context('forkserver')
+        self.__executor = self.__startExecutor()
+        self.__pending = None
+        self.__submittedSequence = self.sensorState.sequence
+
+    def publish(self, **fields):
+        """ Publish new sensor state to the planner processes """
+        self.sensorState.write(**fields)
+
+    def poll(self):
+        """ Collect a finished plan and submit the next one
+
+        Never blocks, to be called from every pass of the robot loop.
+
+        Returns:
+            A fresh MotorSetpoint or None if no new plan is available
+        """
+
+        setpoint = None
+
+        if self.__pending is not None and self.__pending.done():
+            future, self.__pending = self.__pending, None
+            try:
+                setpoint = future.result()
+            except BrokenProcessPool:
+                return self.__restartExecutor()
+            except Exception:
+                logging.exception("planner: plan failed")
+                self.failedPlans += 1
+
+            if setpoint is not None and monotonic() > setpoint.deadline:
+                logging.debug("planner: dropped plan %.3fs past deadline",
+                              monotonic() - setpoint.deadline)
+                self.stalePlans += 1
+                setpoint = None
+
+        if (self.__pending is None and
+                self.sensorState.sequence != self.__submittedSequence):
+            self.__submittedSequence = self.sensorState.sequence
+            try:
+                self.__pending = self.__executor.submit(_runPlanner,
+                                                        self.maxAge)
+            except BrokenProcessPool:
+                return self.__restartExecutor()
+
+        return setpoint
+
+    def __startExecutor(self):
+        """ Start a pool of planner worker processes
+
+        The robot runs the telemetry writer and profiler threads, a
+        forked worker could inherit a lock held by one of them and
+        hang. The workers are started from a forkserver instead, which
+        forks from a clean single threaded process.
+        """
+
+        return ProcessPoolExecutor(max_workers=self.maxWorkers,
+                                   mp_context=self.__mpContext,
+                                   initializer=_initWorker,
+                                   initargs=(self.sensorState.name,
+                                             self.planner))
+
+    def __restartExecutor(self):
+        """ Replace a broken pool and return a stop setpoint """
+
+        logging.error("planner: worker process died, restarting pool")
+        self.failedPlans += 1
+        self.__pending = None
+        self.__executor.shutdown(wait=False)
+        self.__executor = self.__startExecutor()
+
+        # Plan again on the current state with the new pool
+        self.__submittedSequence = None
+        return MotorSetpoint(0, 0, monotonic() + self.maxAge)
+
+    def shutdown(self):
+        """ Stop the worker processes and remove the shared memory """
+
+        if self.__pending is not None:
+            self.__pending.cancel()
+        self.__executor.shutdown(wait=True)
+        self.sensorState.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import signal
+import logging
+import functools
+import threading
+from collections import Counter
+from time import perf_counter, sleep, strftime
+from time_sync import LatencyHistogram
+
+
+class _NullSpan:
+
+    """ Span used while stage timing is disabled, does nothing """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    """ Times a single pass through a stage """
+
+    __slots__ = ('histogram', 'startTime')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.startTime = perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.histogram.add(perf_counter() - self.startTime)
+        return False
+
+
+class StageTimer:
+
+    """ Opt-in timing of the stages of the robot loop
+
+    Stages are timed with a span, either as a context manager
+
+        with stageTimer.span('decode'):
+            ...
+
+    or by decorating a function with @stageTimer.timed('dispatch').
+    Every stage gets its own LatencyHistogram. Spans may be nested,
+    e.g. the 'log' span around logging calls inside 'send', 'decode'
+    and 'dispatch', an outer stage includes the time of its inner ones.
+
+    Timing is off by default. A disabled span is a shared object that
+    does nothing, so leaving the spans in the robot loop costs no more
+    than a method call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}            # stage name: LatencyHistogram
+
+    def enable(self):
+        """ Start timing, clears the previous measurements """
+
+        self.stages = {}
+        self.enabled = True
+
+    def disable(self):
+        """ Stop timing, the measurements are kept for reporting """
+        self.enabled = False
+
+    def span(self, name):
+        """ Returns a context manager timing the stage name """
+
+        if not self.enabled:
+            return _NULL_SPAN
+
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = LatencyHistogram(name)
+        return _Span(histogram)
+
+    def timed(self, name):
+        """ Decorator timing every call of a function as stage name """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self):
+        """ Log the histogram of every timed stage """
+
+        for name in sorted(self.stages):
+            logging.info("stage %s", self.stages[name])
+
+
+stageTimer = StageTimer()   # shared by the Robot and HardwareController
+
+
+class SamplingProfiler:
+
+    """ Samples the stack of a thread for a fixed window of time
+
+    A background thread periodically grabs the current stack of the
+    profiled thread using sys._current_frames() and counts how often
+    every stack is seen. When the window is over the counts are written
+    in the collapsed stack format used by flamegraph.pl and speedscope:
+
+        main (morTimmy.py:170);run (morTimmy.py:80);recvMessage (...) 42
+
+    Nothing is hooked into the interpreter, so the profiled thread
+    only pays for the sampling thread holding the GIL while it walks
+    the stack. Outside of a window there is no overhead at all.
+    """
+
+    def __init__(self, outputDirectory='.', interval=0.005):
+        """ Initializes the profiler
+
+        Args:
+            outputDirectory (str): Directory the profiles are written to
+            interval (float): Seconds between two samples
+        """
+
+        self.outputDirectory = outputDirectory
+        self.interval = interval
+        self.__thread = None
+
+    @property
+    def isRunning(self):
+        """ True while a profile window is being recorded """
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self, duration=10.0, threadId=None):
+        """ Start sampling a thread for duration seconds
+
+        Args:
+            duration (float): Length of the profile window in seconds
+            threadId (int): Thread to profile, defaults to the calling
+                            thread
+
+        Returns:
+            The filename the profile will be written to or None if a
+            profile is already being recorded
+        """
+
+        if self.isRunning:
+            logging.warning("profiler: already recording a profile")
+            return None
+
+        if threadId is None:
+            threadId = threading.get_ident()
+        filename = os.path.join(self.outputDirectory,
+                                strftime('morTimmy-%Y%m%d-%H%M%S.folded'))
+
+        self.__thread = threading.Thread(target=self.__sample,
+                                         args=(threadId, duration, filename),
+                                         name='SamplingProfiler',
+                                         daemon=True)
+        self.__thread.start()
+        logging.info("profiler: recording %.1fs profile to %s",
+                     duration, filename)
+        return filename
+
+    def installSignalHandler(self, signum=signal.SIGUSR1, duration=10.0):
+        """ Start a profile of the main thread when signum is received
+
+        Has to be called from the main thread, e.g.
+
+            kill -USR1 <pid of morTimmy>
+        """
+
+        mainThreadId = threading.get_ident()
+
+        def handler(signum, frame):
+            self.start(duration, mainThreadId)
+
+        signal.signal(signum, handler)
+
+    def __sample(self, threadId, duration, filename):
+        """ Sample the stack of threadId and write the collapsed stacks """
+
+        stacks = Counter()
+        endTime = perf_counter() + duration
+        while perf_counter() < endTime:
+            frame = sys._current_frames().get(threadId)
+            if frame is None:
+                break
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+
+            sleep(self.interval)
+
+        try:
+            with open(filename, 'w') as profileFile:
+                for stack, count in stacks.most_common():
+                    profileFile.write('%s %d\n' % (stack, count))
+            logging.info("profiler: wrote %d samples to %s",
+                         sum(stacks.values()), filename)
+        except OSError:
+            logging.exception("profiler: failed to write %s", filename)
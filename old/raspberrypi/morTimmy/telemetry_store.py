@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import os
+import mmap
+import struct
+import queue
+import threading
+import logging
+
+# Definitions
+
+RECORD = struct.Struct('<dd')       # timestamp, value
+COLUMN_EXTENSION = '.col'
+QUERY_BLOCK_RECORDS = 4096          # records unpacked at once by queries
+
+
+class TelemetryStore:
+
+    """ Append-only columnar time series store for robot telemetry
+
+    Every module/field combination gets its own column file in the
+    store directory, e.g. distanceSensor.distance.col. A column file is
+    a flat array of little endian (timestamp, value) doubles. Files
+    are only ever appended to, so they survive restarts of the robot
+    and several hours of data simply end up as a longer file.
+
+    Writing happens in a background thread. append() only puts the
+    sample on a bounded queue and never blocks the robot loop; if the
+    writer can't keep up the sample is dropped and counted in
+    droppedSamples. The writer collects samples into chunks and writes
+    each column with a single write call.
+
+    Queries memory map the column file and binary search the
+    timestamps, so only the requested range is touched. Timestamps of
+    a column must therefore be non-decreasing, samples older than the
+    last written sample of their column are dropped by the writer. A
+    warning is logged when a column starts dropping samples, e.g.
+    after the system clock was set back.
+
+        store = TelemetryStore('telemetry')
+        store.append('distanceSensor', 'distance', time(), 42)
+        store.downsample('distanceSensor', 'distance',
+                         time() - 3600, time(), 60)
+    """
+
+    def __init__(self, directory, chunkSize=256, flushInterval=1.0,
+                 maxQueueSize=10000):
+        """ Initializes the store and starts the writer thread
+
+        Args:
+            directory (str): Directory holding the column files
+            chunkSize (int): Number of samples collected before writing
+            flushInterval (float): Maximum seconds a sample waits in
+                                   the writer before it is written
+            maxQueueSize (int): Maximum number of samples waiting
+                                for the writer
+        """
+
+        self.directory = directory
+        self.chunkSize = chunkSize
+        self.flushInterval = flushInterval
+        self.droppedSamples = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.__queue = queue.Queue(maxsize=maxQueueSize)
+        self.__files = {}           # column name: open file
+        self.__lastTimestamps = {}  # column name: last written timestamp
+        self.__outOfOrderColumns = set()    # columns dropping old samples
+        self.__writer = threading.Thread(target=self.__writeLoop,
+                                         name='TelemetryStoreWriter',
+                                         daemon=True)
+        self.__writer.start()
+
+    def append(self, module, field, timestamp, value):
+        """ Queue a sample for writing, never blocks
+
+        Args:
+            module (str): Name of the module, e.g. distanceSensor
+            field (str): Name of the field, e.g. distance
+            timestamp (float): Time of the sample in seconds
+            value (float): The sample value
+
+        Returns:
+            True if the sample was queued, False if it was dropped
+        """
+
+        try:
+            self.__queue.put_nowait((self.columnName(module, field),
+                                     timestamp, value))
+            return True
+        except queue.Full:
+            self.droppedSamples += 1
+            return False
+
+    def flush(self):
+        """ Block until all queued samples are written to disk """
+        self.__queue.join()
+
+    def close(self):
+        """ Write all queued samples and stop the writer thread """
+
+        if self.__writer.is_alive():
+            self.__queue.put(None)
+            self.__writer.join()
+
+    def columns(self):
+        """ Returns a list of (module, field) tuples in the store """
+
+        return [tuple(filename[:-len(COLUMN_EXTENSION)].split('.', 1))
+                for filename in sorted(os.listdir(self.directory))
+                if filename.endswith(COLUMN_EXTENSION)]
+
+    def range(self, module, field, start, end):
+        """ Return all samples of a column between start and end
+
+        Args:
+            module (str): Name of the module
+            field (str): Name of the field
+            start (float): Timestamp of the first sample (inclusive)
+            end (float): Timestamp of the last sample (exclusive)
+
+        Returns:
+            A list of (timestamp, value) tuples
+        """
+
+        samples = []
+        for block in self.__iterBlocks(module, field, start, end):
+            samples.extend(block)
+        return samples
+
+    def downsample(self, module, field, start, end, bucketSize):
+        """ Summarize a column in fixed size time buckets
+
+        The column is walked block by block so memory use does not
+        depend on the length of the requested range.
+
+        Args:
+            module (str): Name of the module
+            field (str): Name of the field
+            start (float): Start of the first bucket (inclusive)
+            end (float): End of the last bucket (exclusive)
+            bucketSize (float): Width of a bucket in seconds
+
+        Returns:
+            A list of (bucketStart, minimum, maximum, mean, count)
+            tuples, buckets without samples are left out
+        """
+
+        if bucketSize <= 0:
+            raise ValueError("bucketSize must be positive")
+
+        buckets = []
+        bucketIndex = None
+        for block in self.__iterBlocks(module, field, start, end):
+            for timestamp, value in block:
+                index = int((timestamp - start) // bucketSize)
+                if index != bucketIndex:
+                    if bucketIndex is not None:
+                        buckets.append((start + bucketIndex * bucketSize,
+                                        minimum, maximum, total / count,
+                                        count))
+                    bucketIndex = index
+                    minimum = maximum = total = value
+                    count = 1
+                else:
+                    if value < minimum:
+                        minimum = value
+                    elif value > maximum:
+                        maximum = value
+                    total += value
+                    count += 1
+
+        if bucketIndex is not None:
+            buckets.append((start + bucketIndex * bucketSize,
+                            minimum, maximum, total / count, count))
+        return buckets
+
+    @staticmethod
+    def columnName(module, field):
+        """ Returns the name of the column for a module and field """
+
+        if '.' in module or os.sep in module or os.sep in field:
+            raise ValueError("Invalid column %s.%s" % (module, field))
+        return '%s.%s' % (module, field)
+
+    def __columnPath(self, column):
+        return os.path.join(self.directory, column + COLUMN_EXTENSION)
+
+    def __iterBlocks(self, module, field, start, end):
+        """ Yield blocks of (timestamp, value) tuples within a range
+
+        The column is memory mapped read-only. Only whole records
+        are mapped, a record that is half written by the writer
+        thread at this moment is simply not seen yet.
+        """
+
+        path = self.__columnPath(self.columnName(module, field))
+        try:
+            with open(path, 'rb') as columnFile:
+                numRecords = os.fstat(columnFile.fileno()).st_size // RECORD.size
+                if numRecords == 0:
+                    return
+                with mmap.mmap(columnFile.fileno(),
+                               numRecords * RECORD.size,
+                               access=mmap.ACCESS_READ) as columnMap:
+                    first = self.__search(columnMap, numRecords, start)
+                    last = self.__search(columnMap, numRecords, end)
+                    while first < last:
+                        blockEnd = min(first + QUERY_BLOCK_RECORDS, last)
+                        yield list(RECORD.iter_unpack(
+                            columnMap[first * RECORD.size:
+                                      blockEnd * RECORD.size]))
+                        first = blockEnd
+        except FileNotFoundError:
+            return
+
+    @staticmethod
+    def __search(columnMap, numRecords, timestamp):
+        """ Index of the first record at or after timestamp """
+
+        low, high = 0, numRecords
+        while low < high:
+            middle = (low + high) // 2
+            if RECORD.unpack_from(columnMap, middle * RECORD.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __openColumn(self, column):
+        """ Open a column for appending and read its last timestamp """
+
+        path = self.__columnPath(column)
+        columnFile = open(path, 'ab')
+
+        # Cut off a partially written record left by a crash
+        size = os.path.getsize(path)
+        if size % RECORD.size:
+            columnFile.truncate(size - size % RECORD.size)
+            size -= size % RECORD.size
+
+        if size:
+            with open(path, 'rb') as existing:
+                existing.seek(size - RECORD.size)
+                self.__lastTimestamps[column] = RECORD.unpack(
+                    existing.read(RECORD.size))[0]
+
+        self.__files[column] = columnFile
+        return columnFile
+
+    def __writeChunk(self, chunk):
+        """ Write a chunk of samples, one write call per column """
+
+        columns = {}
+        for column, timestamp, value in chunk:
+            columns.setdefault(column, []).append((timestamp, value))
+
+        for column, samples in columns.items():
+            try:
+                columnFile = self.__files.get(column) or self.__openColumn(column)
+                lastTimestamp = self.__lastTimestamps.get(column)
+                data = bytearray()
+                for timestamp, value in samples:
+                    if lastTimestamp is not None and timestamp < lastTimestamp:
+                        if column not in self.__outOfOrderColumns:
+                            logging.warning("TelemetryStore: dropping samples "
+                                            "of %s older than %.3f",
+                                            column, lastTimestamp)
+                            self.__outOfOrderColumns.add(column)
+                        self.droppedSamples += 1
+                        continue
+                    if column in self.__outOfOrderColumns:
+                        logging.info("TelemetryStore: %s is in order again",
+                                     column)
+                        self.__outOfOrderColumns.discard(column)
+                    data += RECORD.pack(timestamp, value)
+                    lastTimestamp = timestamp
+                columnFile.write(data)
+                columnFile.flush()
+                self.__lastTimestamps[column] = lastTimestamp
+            except (OSError, struct.error, TypeError):
+                logging.exception("TelemetryStore: failed to write column %s",
+                                  column)
+                self.droppedSamples += len(samples)
+
+    def __writeLoop(self):
+        """ Collect samples from the queue and write them in chunks """
+
+        running = True
+        while running:
+            chunk = []
+            try:
+                sample = self.__queue.get(timeout=self.flushInterval)
+                while True:
+                    if sample is None:
+                        running = False
+                        self.__queue.task_done()
+                        break
+                    chunk.append(sample)
+                    if len(chunk) >= self.chunkSize:
+                        break
+                    sample = self.__queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            if chunk:
+                self.__writeChunk(chunk)
+                for _ in chunk:
+                    self.__queue.task_done()
+
+        for columnFile in self.__files.values():
+            columnFile.close()
+        self.__files.clear()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import bisect
+import logging
+from collections import deque
+
+# Definitions
+
+ARDUINO_CLOCK_WRAP = 2 ** 32    # millis() on the Arduino is an unsigned long
+MAX_CLOCK_DRIFT = 0.01          # largest believable clock drift (1%)
+
+
+class LatencyHistogram:
+
+    """ Fixed bucket histogram for latency measurements
+
+    Latencies are added in seconds and sorted into buckets with
+    upper bounds given in milliseconds. The last bucket catches
+    everything above the highest bound. Keeping fixed buckets means
+    adding a value is cheap enough to do from the robot loop and
+    the histogram never grows, no matter how long the robot runs.
+    """
+
+    BUCKET_BOUNDS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+    def __init__(self, name):
+        """ Initializes an empty histogram
+
+        Args:
+            name (str): Name used when logging the histogram
+        """
+
+        self.name = name
+        self.buckets = [0] * (len(self.BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, latency):
+        """ Add a latency measurement to the histogram
+
+        Args:
+            latency (float): The measured latency in seconds
+        """
+
+        latencyMs = latency * 1000
+        self.buckets[bisect.bisect_left(self.BUCKET_BOUNDS_MS,
+                                        latencyMs)] += 1
+        self.count += 1
+        self.total += latency
+        if self.minimum is None or latency < self.minimum:
+            self.minimum = latency
+        if self.maximum is None or latency > self.maximum:
+            self.maximum = latency
+
+    def mean(self):
+        """ Returns the mean latency in seconds or None if empty """
+
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """ Estimate a latency percentile from the buckets
+
+        The upper bound of the bucket holding the requested
+        percentile is returned, so the result is an upper estimate.
+        It is capped at the largest seen latency.
+
+        Args:
+            percent (float): The percentile to return (0-100)
+
+        Returns:
+            The estimated latency in seconds or None if empty
+        """
+
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for index, bucketCount in enumerate(self.buckets):
+            seen += bucketCount
+            if seen >= threshold and bucketCount:
+                if index < len(self.BUCKET_BOUNDS_MS):
+                    return min(self.BUCKET_BOUNDS_MS[index] / 1000.0,
+                               self.maximum)
+                break
+        return self.maximum
+
+    def reset(self):
+        """ Clears all measurements from the histogram """
+
+        self.buckets = [0] * (len(self.BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def __str__(self):
+        if not self.count:
+            return "%s: no samples" % self.name
+
+        bounds = ["<=%sms" % bound for bound in self.BUCKET_BOUNDS_MS]
+        bounds.append(">%sms" % self.BUCKET_BOUNDS_MS[-1])
+        buckets = " ".join("%s:%d" % (bound, bucketCount)
+                           for bound, bucketCount in zip(bounds, self.buckets)
+                           if bucketCount)
+        return ("%s: n=%d min=%.2fms mean=%.2fms p99<=%.2fms "
+                "max=%.2fms [%s]") % (self.name,
+                                      self.count,
+                                      self.minimum * 1000,
+                                      self.mean() * 1000,
+                                      self.percentile(99) * 1000,
+                                      self.maximum * 1000,
+                                      buckets)
+
+
+class TimeSync:
+
+    """ Estimates the Arduino clock relative to the Raspberry Pi clock
+
+    The exchange works like a stripped down NTP. The Pi sends a
+    CMD_ARDUINO_TIMESYNC message and remembers when it was sent (t1).
+    The Arduino answers with the messageID of the request in the
+    acknowledgeID field and its millis() value in the data field (t2).
+    The Pi notes the time the answer arrived (t4).
+
+    Assuming the link is symmetric, the Arduino clock read t2 at the
+    local time (t1 + t4) / 2. Samples with a long round trip are the
+    least trustworthy, so only the fastest samples in the history are
+    used to fit the line
+
+        deviceTime = offset + rate * localTime
+
+    where rate - 1 is the drift of the Arduino clock against the Pi
+    clock. All times are in seconds, local times are expected to come
+    from time.monotonic().
+
+    Every completed exchange also feeds the per direction latency
+    histograms. Since NTP can only measure the round trip, the split
+    between the upstream (Pi to Arduino) and downstream (Arduino to Pi)
+    latency is made against the fitted clock, so a persistent
+    asymmetry ends up in the offset but jitter on either side of the
+    link shows up in its own histogram.
+    """
+
+    def __init__(self, historySize=32, bestSamples=8, maxPending=16):
+        """ Initializes the TimeSync
+
+        Args:
+            historySize (int): Number of exchanges to remember
+            bestSamples (int): Number of exchanges with the shortest
+                               round trip used to fit the clock
+            maxPending (int): Maximum number of unanswered requests
+                              to keep track of
+        """
+
+        self.__pending = {}         # messageID: local send time
+        self.__maxPending = maxPending
+        self.__samples = deque(maxlen=historySize)
+        self.__bestSamples = bestSamples
+        self.__lastRawDeviceTime = None
+        self.__deviceClockWraps = 0
+
+        self.offset = None
+        self.rate = 1.0
+        self.roundTrip = LatencyHistogram('roundTrip')
+        self.upstream = LatencyHistogram('upstream')
+        self.downstream = LatencyHistogram('downstream')
+
+    @property
+    def isSynchronized(self):
+        """ True when at least one exchange has completed """
+        return self.offset is not None
+
+    @property
+    def driftPpm(self):
+        """ The drift of the Arduino clock in parts per million """
+        return (self.rate - 1.0) * 1e6
+
+    def requestSent(self, messageID, localTime):
+        """ Register an outgoing time sync request
+
+        Args:
+            messageID (int): The messageID of the request
+            localTime (float): The local time the request was sent
+        """
+
+        if len(self.__pending) >= self.__maxPending:
+            # The Arduino never answered these, drop the oldest one
+            del self.__pending[min(self.__pending)]
+        self.__pending[messageID] = localTime
+
+    def isPending(self, acknowledgeID):
+        """ Returns True if acknowledgeID answers an open request """
+        return acknowledgeID in self.__pending
+
+    def replyReceived(self, acknowledgeID, deviceMillis, localTime):
+        """ Process the answer to a time sync request
+
+        Args:
+            acknowledgeID (int): The acknowledgeID of the reply
+            deviceMillis (int): The Arduino millis() value of the reply
+            localTime (float): The local time the reply was received
+
+        Returns:
+            True if the reply matched an open request
+        """
+
+        sendTime = self.__pending.pop(acknowledgeID, None)
+        if sendTime is None:
+            return False
+
+        deviceTime = self.__unwrapDeviceTime(deviceMillis)
+        roundTrip = localTime - sendTime
+        midpoint = (sendTime + localTime) / 2.0
+
+        self.__samples.append((roundTrip, midpoint, deviceTime))
+        self.__fitClock()
+
+        deviceTimeLocal = self.toLocalTime(deviceTime)
+        self.roundTrip.add(roundTrip)
+        # Not clamped to zero, negative latencies point at a bad fit
+        self.upstream.add(deviceTimeLocal - sendTime)
+        self.downstream.add(localTime - deviceTimeLocal)
+        return True
+
+    def toDeviceTime(self, localTime):
+        """ Convert a local time to the estimated Arduino time
+
+        Returns:
+            The Arduino time in seconds or None if not synchronized
+        """
+
+        if self.offset is None:
+            return None
+        return self.offset + self.rate * localTime
+
+    def toLocalTime(self, deviceTime):
+        """ Convert an Arduino time to the estimated local time
+
+        Returns:
+            The local time in seconds or None if not synchronized
+        """
+
+        if self.offset is None:
+            return None
+        return (deviceTime - self.offset) / self.rate
+
+    def estimateSendTime(self, localRecvTime):
+        """ Estimate the Arduino time a received message was sent
+
+        Messages from the Arduino carry no timestamp, so the send time
+        is estimated from the local receive time minus the mean
+        downstream latency.
+
+        Args:
+            localRecvTime (float): The local time the message arrived
+
+        Returns:
+            The Arduino time in seconds or None if not synchronized
+        """
+
+        if self.offset is None:
+            return None
+        return self.toDeviceTime(localRecvTime -
+                                 (self.downstream.mean() or 0.0))
+
+    def __unwrapDeviceTime(self, deviceMillis):
+        """ Converts the wrapping Arduino millis() value to seconds """
+
+        if (self.__lastRawDeviceTime is not None and
+                deviceMillis < self.__lastRawDeviceTime and
+                self.__lastRawDeviceTime - deviceMillis >
+                ARDUINO_CLOCK_WRAP // 2):
+            self.__deviceClockWraps += 1
+        self.__lastRawDeviceTime = deviceMillis
+
+        return ((self.__deviceClockWraps * ARDUINO_CLOCK_WRAP +
+                 deviceMillis) / 1000.0)
+
+    def __fitClock(self):
+        """ Least squares fit of the clock over the fastest exchanges """
+
+        best = sorted(self.__samples)[:self.__bestSamples]
+        n = len(best)
+        meanLocal = sum(sample[1] for sample in best) / n
+        meanDevice = sum(sample[2] for sample in best) / n
+
+        spread = sum((sample[1] - meanLocal) ** 2 for sample in best)
+        if n >= 2 and spread > 0:
+            rate = sum((sample[1] - meanLocal) * (sample[2] - meanDevice)
+                       for sample in best) / spread
+            # Reject fits that are obviously off. The ATmega usually
+            # runs from a ceramic resonator rated around 0.5%, so
+            # anything well beyond that is a measurement problem
+            if abs(rate - 1.0) < MAX_CLOCK_DRIFT:
+                self.rate = rate
+            else:
+                logging.warning("timesync: rejected clock fit with "
+                                "drift %.0fppm, keeping %.0fppm",
+                                (rate - 1.0) * 1e6, self.driftPpm)
+
+        self.offset = meanDevice - self.rate * meanLocal